@@ -33,22 +33,201 @@ For each non-preamble chunk, construct a Codex prompt consisting of the contents
  - If the script was called with a filename, output the commented code to a .new file. Otherwise output it to stdout.
 """
 
+import argparse
+import ast
+import hashlib
+import io
 import json
+import logging
 import os
+import random
 import re
 import requests
 import sys
+import tempfile
+import threading
+import time
+import tokenize
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson encodes and decodes JSON several times faster than the json module, so use it if it's installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 GPT_API_KEY = os.environ['GPT_API_KEY']
 
+# Progress and debugging messages go to stderr through logging, so they never mix with the commented code
+logger = logging.getLogger('auto-commenter')
+
+# Maximum number of Codex API requests to have in flight at once
+MAX_CONCURRENCY = 8
+# Maximum number of prompts to send in a single Codex API call. A call only returns once its longest
+# completion is done, so bigger batches make fewer calls but each one takes longer.
+BATCH_SIZE = 8
+# Maximum number of tokens Codex may generate for each prompt
+MAX_TOKENS = 1500
+# Chunks with at least this many comment lines per line of code are already commented well enough to leave alone
+COMMENT_DENSITY = 0.3
+# Seconds to wait for the Codex API before giving up on a request
+REQUEST_TIMEOUT = 120
+
+# Maximum number of attempts for each API call, and the cap in seconds on the wait between attempts
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 60
+# HTTP status codes worth retrying: rate limited (429), or a transient server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# OpenAI account rate limits to stay under, in requests per minute and tokens per minute
+MAX_REQUESTS_PER_MINUTE = 3500
+MAX_TOKENS_PER_MINUTE = 90000
+
+# davinci-codex has been retired, so use its replacement on the same completions API
+API_URL = 'https://api.openai.com/v1/completions'
+JSON_HEADERS = {'Content-Type': 'application/json'}
+MODEL = 'gpt-3.5-turbo-instruct'
+# OpenAI Batch API endpoints, for running all the requests as one job at half the cost, within 24 hours
+FILES_URL = 'https://api.openai.com/v1/files'
+BATCHES_URL = 'https://api.openai.com/v1/batches'
+# Seconds to wait between checks on whether a batch job has finished
+BATCH_POLL_INTERVAL = 30
+# Each prompt is the example, the code chunk, and the line asking for the commented version of the chunk
+PROMPT_TEMPLATE = '{example}\n{chunk}\nSame function with verbose inline comments:\n'
+# Directory to cache Codex responses in, so re-running on unchanged code doesn't call the API again
+CACHE_DIR = os.path.expanduser('~/.cache/auto-commenter')
+# A python or java function definition line, for splitting code that can't be parsed as python
+_FN_RE = re.compile(r'^\s*(def|public|private)\s')
+
+def make_adapter(pool_size):
+    """
+    Make an HTTPS adapter that keeps up to pool_size connections alive, and retries connections that
+    couldn't be made with exponential backoff. Only connect errors are retried here, before any of the
+    request was sent, so a POST is never sent twice without the rate limiter knowing; read errors,
+    timeouts, and error responses are all retried by post_with_retry.
+    """
+    return HTTPAdapter(pool_maxsize=pool_size, max_retries=Retry(total=5, connect=5, read=0, status=0, backoff_factor=0.5))
+
+# Share one keep-alive connection pool across all API calls, so each call doesn't pay for its own
+# TCP and TLS handshake. The pool holds a connection per worker thread.
+SESSION = requests.Session()
+# Every API call is authenticated the same way, so set the header once for the whole session
+SESSION.headers['Authorization'] = 'Bearer {}'.format(GPT_API_KEY)
+SESSION.mount('https://', make_adapter(MAX_CONCURRENCY))
+# Worker threads for the API calls, shared by every file being commented
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+
+class RateLimiter:
+    """
+    Token bucket rate limiter, to keep API calls under both a requests per minute and a tokens per minute limit.
+    Limits that aren't given start at the defaults, and follow the account's real limits once the API reports them.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        # Remember which limits to take from the API's response headers
+        self.calibrate_requests = requests_per_minute is None
+        self.calibrate_tokens = tokens_per_minute is None
+        self.requests_per_minute = requests_per_minute or MAX_REQUESTS_PER_MINUTE
+        self.tokens_per_minute = tokens_per_minute or MAX_TOKENS_PER_MINUTE
+        # Start with both buckets full
+        self.available_requests = self.requests_per_minute
+        self.available_tokens = self.tokens_per_minute
+        self.last_update = time.monotonic()
+        # Time before which no requests should be sent at all, after the API has rate limited one
+        self.paused_until = 0
+        # Worker threads share the buckets, so only let one at a time touch them
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Top up both buckets in proportion to the time since they were last topped up
+        """
+        now = time.monotonic()
+        minutes = (now - self.last_update) / 60
+        self.last_update = now
+        self.available_requests = min(self.requests_per_minute, self.available_requests + minutes * self.requests_per_minute)
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + minutes * self.tokens_per_minute)
+
+    def acquire(self, tokens):
+        """
+        Wait until there is capacity for one more request using the given number of tokens, then take it
+        """
+        # A request bigger than the whole token bucket would never fit, so just wait for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self.refill()
+                pause = self.paused_until - time.monotonic()
+                # If we're not paused and there's room for the request, take it out of both buckets and go
+                if pause <= 0 and self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                # Otherwise work out how long until the pause is over and both buckets will have enough
+                wait = max(pause, (1 - self.available_requests) / self.requests_per_minute * 60,
+                           (tokens - self.available_tokens) / self.tokens_per_minute * 60)
+            time.sleep(wait)
+
+    def calibrate(self, headers):
+        """
+        Switch to the account's real rate limits, from the x-ratelimit-limit-* headers of an API response
+        """
+        with self.lock:
+            # Top up the buckets at the old rates first, since they applied until now
+            self.refill()
+            try:
+                if self.calibrate_requests:
+                    self.requests_per_minute = int(headers['x-ratelimit-limit-requests'])
+                if self.calibrate_tokens:
+                    self.tokens_per_minute = int(headers['x-ratelimit-limit-tokens'])
+            # Responses without the headers (or with unexpected values) leave the limits as they were
+            except (KeyError, ValueError):
+                pass
+            # Don't let the buckets hold more than the new limits allow
+            self.available_requests = min(self.available_requests, self.requests_per_minute)
+            self.available_tokens = min(self.available_tokens, self.tokens_per_minute)
+
+    def pause(self, seconds):
+        """
+        Hold back all requests for the given number of seconds, once the API has rate limited one of them
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def refund(self, tokens):
+        """
+        Give back tokens that were estimated but not used (or take more, if tokens is negative)
+        """
+        with self.lock:
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + tokens)
+
+# Pace all API calls to stay under the account's rate limits, rather than relying on retrying 429s
+LIMITER = RateLimiter()
+
 """
 The algorithm above should be divided into modular functions. The top-level functions are:
 
 - read_code
 - split_into_chunks
-- comment_chunk
+- split_into_chunks_by_regex
+- needs_processing
+- json_dumps
+- json_loads
+- estimate_tokens
+- post_with_retry
+- chunk_payload
+- comment_chunks
+- submit_batch
+- wait_for_batch
+- get_batch_results
+- comment_chunks_in_batch_job
+- comment_distinct_chunks
+- comment_code_chunks
 - comment_code
+- write_new_file
 - comment_code_from_file
+- comment_code_from_files
 - comment_code_from_stdin
 """
 
@@ -71,69 +250,435 @@ def split_into_chunks(code):
     """
     Split code into chunks, each chunk being a function definition
     """
+    # Try to parse the code as python
+    try:
+        tree = ast.parse(code)
+    # If it isn't python (such as java), split it with a regex instead
+    except (SyntaxError, ValueError):
+        return split_into_chunks_by_regex(code)
+    # Split the code into lines with their own line endings, only at the line breaks ast counts lines by
+    # (unlike str.splitlines, which also breaks at form feeds and other separators)
+    lines = io.StringIO(code, newline='').readlines()
+    # Find the line each function definition starts on, including any decorators (0-based, and each line only once)
+    starts = sorted({
+        min([node.lineno] + [decorator.lineno for decorator in node.decorator_list]) - 1
+        for node in ast.walk(tree)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+    })
+    # The first chunk is the preamble before the first function, then one chunk starts at each function
+    bounds = [0] + starts + [len(lines)]
+    # Slice the lines into chunks between each pair of bounds, keeping the code's text exactly as it was
+    return [''.join(lines[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+def split_into_chunks_by_regex(code):
+    """
+    Split code that can't be parsed as python into chunks, each chunk being a function definition
+    """
     # Create an empty list to store chunks
     chunks = []
-    # Create a string to store the current chunk
-    chunk = ''
-    # For each line in the code
-    for line in code.splitlines():
+    # Create a list to store the lines of the current chunk, to join once it's complete
+    lines = []
+    # For each line in the code, with its line ending
+    for line in io.StringIO(code, newline='').readlines():
         # If the line is a python or java function definition
-        if re.match(r'^\s*(def|public|private)\s', line):
+        if _FN_RE.match(line):
             # Add the current chunk to the list of chunks
-            chunks.append(chunk)
+            chunks.append(''.join(lines))
             # And reset the current chunk
-            chunk = ''
+            lines = []
         # Add the line to the current chunk
-        chunk += line + '\n'
+        lines.append(line)
     # Add the last chunk to the list of chunks
-    chunks.append(chunk)
+    chunks.append(''.join(lines))
     # Return the list of chunks
     return chunks
 
-def comment_chunk(chunk):
+def needs_processing(chunk):
     """
-    Comment a single chunk of code
+    Return whether a chunk has code that isn't already well commented, and so is worth sending to Codex
     """
-    prompt = open('autocomment-example.txt', 'r').read()
-    prompt += '\n' + chunk + '\nSame function with verbose inline comments:\n'
-    #print(prompt)
-    data = json.dumps({
-        "prompt": prompt,
-        "max_tokens": 1500,
+    # Find the lines with comments on them, and the lines with code on them
+    comment_lines = set()
+    code_lines = set()
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(chunk).readline):
+            if token.type == tokenize.COMMENT:
+                comment_lines.add(token.start[0])
+            elif token.type not in (tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER):
+                code_lines.add(token.start[0])
+    # If it can't be tokenized as python (such as java), let Codex comment it
+    except (tokenize.TokenError, SyntaxError):
+        return True
+    # A chunk without any code, like an empty preamble, has nothing to comment
+    if not code_lines:
+        return False
+    # Otherwise it's worth commenting unless it already has enough comments
+    return len(comment_lines) / len(code_lines) < COMMENT_DENSITY
+
+def json_dumps(obj):
+    """
+    Encode obj as JSON bytes, using orjson if it's installed
+    """
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+def json_loads(data):
+    """
+    Decode JSON bytes, using orjson if it's installed
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def estimate_tokens(text):
+    """
+    Roughly estimate the number of tokens in text, at about 4 characters per token
+    """
+    return len(text) // 4 + 1
+
+def post_with_retry(data, tokens):
+    """
+    POST a request to the Codex API, retrying rate limit and server errors, timeouts, and dropped connections
+    with exponential backoff
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        LIMITER.acquire(tokens)
+        try:
+            response = SESSION.post(API_URL, headers=JSON_HEADERS, data=data, timeout=REQUEST_TIMEOUT)
+        # If the request timed out or its connection dropped, try again after a random wait, unless we're out of attempts
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            wait = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+            logger.warning('Codex API call failed (%s), retrying in %.1fs', e, wait)
+            time.sleep(wait)
+            continue
+        # Keep the rate limiter in step with the account's limits
+        LIMITER.calibrate(response.headers)
+        # Return anything that isn't worth retrying, or the last response once we're out of attempts
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+            return response
+        # Wait as long as the API asks us to, if it says
+        try:
+            wait = float(response.headers['Retry-After'])
+        # Otherwise wait a random time of up to 2**attempt seconds, so that concurrent
+        # requests that were rate limited together don't all retry together
+        except (KeyError, ValueError):
+            wait = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+        logger.warning('Codex API returned %s, retrying in %.1fs', response.status_code, wait)
+        # If we've hit the rate limit, every request will, so hold them all back rather than just this one
+        if response.status_code == 429:
+            LIMITER.pause(wait)
+        # Otherwise just wait before trying this request again
+        else:
+            time.sleep(wait)
+
+class LLMCache:
+    """
+    On-disk cache of Codex responses, keyed by a hash of the request that got them
+    """
+    def __init__(self, directory, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+
+    def key(self, payload):
+        """
+        Hash a single-prompt API request into the key to cache its response under, or None if it can't be cached
+        """
+        # Only the same request at temperature 0 is sure to get the same response again
+        if not self.enabled or payload.get('temperature') != 0:
+            return None
+        # The key covers the model, prompt, max_tokens and stop sequence, as well as the API they were sent to
+        return hashlib.sha256((API_URL + json.dumps(payload, sort_keys=True)).encode()).hexdigest()
+
+    def path(self, key):
+        """
+        Return the file to cache key's response in
+        """
+        # Shard the files into subdirectories by the key's first two hex digits, so no one directory gets huge
+        return os.path.join(self.directory, key[:2], key + '.txt')
+
+    def get(self, key):
+        """
+        Return the cached response text for key, or None if it hasn't been cached
+        """
+        if key is None:
+            return None
+        try:
+            with open(self.path(key), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, text):
+        """
+        Cache the response text for key
+        """
+        if key is None:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename it into place, so other threads or runs reading the cache
+        # never see a half written response
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as f:
+            f.write(text)
+        os.replace(f.name, path)
+
+# The cache all the API calls share
+CACHE = LLMCache(CACHE_DIR)
+
+@lru_cache(maxsize=1)
+def _example():
+    """
+    Read the example prompt text, only once however many chunks use it
+    """
+    # Find the example next to this script, wherever it's run from
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autocomment-example.txt'), 'r') as f:
+        return f.read()
+
+def chunk_payload(chunk):
+    """
+    Build the API request body for commenting a single code chunk
+    """
+    return {
+        "model": MODEL,
+        # Keep the example as the first, byte-identical part of every prompt, with only the chunk-specific
+        # text after it, so the API's prompt cache can reuse the shared prefix across calls
+        "prompt": PROMPT_TEMPLATE.format(example=_example(), chunk=chunk),
+        # Codex regenerates the whole chunk with a comment for about every line, roughly doubling it, so budget
+        # for that rather than always letting it generate (and rate limiting for) MAX_TOKENS
+        "max_tokens": min(MAX_TOKENS, 2 * estimate_tokens(chunk) + 32),
         "temperature": 0,
         "stop": "Original code:"
-    })
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': 'Bearer {}'.format(GPT_API_KEY)
     }
-    response = requests.post('https://api.openai.com/v1/engines/davinci-codex/completions', headers=headers, data=data)
-    print(response.json()['choices'][0]['text'])
-    return response.json()['choices'][0]['text']
 
-def comment_code(code):
+def comment_chunks(chunks):
     """
-    Comment code, given as a string.
+    Comment a batch of code chunks with a single Codex API call, returning the commented chunks in order
+    """
+    payloads = [chunk_payload(chunk) for chunk in chunks]
+    logger.debug('Payloads: %s', payloads)
+    # Look up each chunk's commented chunk in the cache
+    keys = [CACHE.key(payload) for payload in payloads]
+    commented_chunks = [CACHE.get(key) for key in keys]
+    # Find the chunks that weren't in the cache
+    missing = [i for i, commented_chunk in enumerate(commented_chunks) if commented_chunk is None]
+    # If there are any, send them all to Codex in a single API call
+    if missing:
+        # max_tokens applies to every prompt in the call, so use the biggest budget of the batch
+        max_tokens = max(payloads[i]['max_tokens'] for i in missing)
+        prompts = [payloads[i]['prompt'] for i in missing]
+        data = json_dumps(dict(payloads[0], prompt=prompts, max_tokens=max_tokens))
+        # Rate limits count each prompt's tokens plus the most tokens it could generate
+        tokens = sum(estimate_tokens(prompt) + max_tokens for prompt in prompts)
+        try:
+            result = json_loads(post_with_retry(data, tokens).content)
+            # Read the whole response before using any of it, so an error response or a malformed one
+            # leaves these chunks uncommented rather than stopping every other worker too
+            # Each choice's index is the position of its prompt among the missing ones
+            choices = [(missing[choice['index']], choice['text'], choice.get('finish_reason')) for choice in result['choices']]
+            used = result['usage']['total_tokens']
+        # If the call still failed after retrying, or the response wasn't what we expected, note why rather than losing the whole file
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error('Codex API call failed, leaving %s chunks uncommented: %s', len(missing), e)
+        except (KeyError, IndexError, TypeError, AttributeError):
+            logger.error('Codex API call failed, leaving %s chunks uncommented: %s', len(missing), result.get('error', result) if isinstance(result, dict) else result)
+        else:
+            # Now we know how many tokens the call really used, give the rest of the estimate back to the rate limiter
+            LIMITER.refund(tokens - used)
+            for i, text, finish_reason in choices:
+                # A chunk cut off at max_tokens has lost the end of its code, so keep the original instead
+                if finish_reason == 'length':
+                    logger.warning('Codex ran out of tokens commenting a chunk, leaving it uncommented')
+                    continue
+                if not isinstance(text, str):
+                    logger.error('Unexpected Codex API response text: %s', text)
+                    continue
+                # Put the commented chunk in its place, and cache it for next time
+                commented_chunks[i] = text
+                CACHE.set(keys[i], text)
+    # Keep the original of each chunk that didn't get commented
+    commented_chunks = [chunk if commented_chunk is None else commented_chunk
+                        for chunk, commented_chunk in zip(chunks, commented_chunks)]
+    return commented_chunks
+
+def submit_batch(payloads):
+    """
+    Submit API request bodies as a single OpenAI Batch API job, returning the job's id
+    """
+    # Write one request per line, with its position as its custom_id so the results can be matched back up
+    lines = [
+        json_dumps({"custom_id": str(i), "method": "POST", "url": "/v1/completions", "body": payload})
+        for i, payload in enumerate(payloads)
+    ]
+    # Upload the requests as a JSONL file
+    response = SESSION.post(FILES_URL, data={'purpose': 'batch'},
+                            files={'file': ('batch.jsonl', b'\n'.join(lines))}, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    input_file_id = json_loads(response.content)['id']
+    # Start a job to run all the requests in the file
+    data = json_dumps({"input_file_id": input_file_id, "endpoint": "/v1/completions", "completion_window": "24h"})
+    response = SESSION.post(BATCHES_URL, headers=JSON_HEADERS, data=data, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return json_loads(response.content)['id']
+
+def wait_for_batch(batch_id):
+    """
+    Wait for a Batch API job to finish, returning the finished job
+    """
+    while True:
+        # Check on the job
+        response = SESSION.get('{}/{}'.format(BATCHES_URL, batch_id), timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        batch = json_loads(response.content)
+        # Return it once it's done, whether or not it succeeded
+        if batch['status'] in ('completed', 'failed', 'expired', 'cancelled'):
+            return batch
+        # Otherwise wait a while and check again
+        logger.info('Batch %s is %s, checking again in %ss', batch_id, batch['status'], BATCH_POLL_INTERVAL)
+        time.sleep(BATCH_POLL_INTERVAL)
+
+def get_batch_results(batch):
+    """
+    Download a finished Batch API job's results, returning a dict of each successful request's custom_id to its text
+    """
+    results = {}
+    # A job where no requests succeeded has no output file
+    if not batch.get('output_file_id'):
+        return results
+    response = SESSION.get('{}/{}/content'.format(FILES_URL, batch['output_file_id']), timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    # The output file has one JSON result per line, in no particular order
+    for line in response.content.splitlines():
+        result = json_loads(line)
+        # Keep the text of each request that succeeded, unless it was cut off at max_tokens
+        if result['response'] and result['response']['status_code'] == 200:
+            choice = result['response']['body']['choices'][0]
+            if choice.get('finish_reason') == 'length':
+                logger.warning('Codex ran out of tokens commenting a chunk, leaving it uncommented')
+                continue
+            results[result['custom_id']] = choice['text']
+    return results
+
+def comment_chunks_in_batch_job(chunks):
+    """
+    Comment code chunks with a single Batch API job, returning the commented chunks in order.
+    Batch jobs cost half as much as individual API calls, but can take up to 24 hours.
+    """
+    payloads = [chunk_payload(chunk) for chunk in chunks]
+    # Look up each chunk's commented chunk in the cache
+    keys = [CACHE.key(payload) for payload in payloads]
+    commented_chunks = [CACHE.get(key) for key in keys]
+    # Find the chunks that weren't in the cache
+    missing = [i for i, commented_chunk in enumerate(commented_chunks) if commented_chunk is None]
+    # If there are any, run them all as one batch job
+    if missing:
+        batch_id = submit_batch([payloads[i] for i in missing])
+        logger.info('Submitted batch %s of %s requests', batch_id, len(missing))
+        batch = wait_for_batch(batch_id)
+        results = get_batch_results(batch)
+        logger.info('Batch %s %s with %s of %s requests succeeded', batch_id, batch['status'], len(results), len(missing))
+        # Each result's custom_id is the position of its chunk among the missing ones
+        for j, i in enumerate(missing):
+            # Leave any chunk whose request failed as it was, without comments
+            if str(j) not in results:
+                commented_chunks[i] = chunks[i]
+                continue
+            # Put the commented chunk in its place, and cache it for next time
+            commented_chunks[i] = results[str(j)]
+            CACHE.set(keys[i], results[str(j)])
+    return commented_chunks
+
+def comment_distinct_chunks(chunks, batch=False):
+    """
+    Comment each distinct chunk only once, however many times it appears, yielding a dict of chunks
+    and their commented versions for each batch, in order, as soon as it and all the batches before it are done
+    """
+    # Find the distinct chunks, in order of first appearance
+    unique_chunks = list(dict.fromkeys(chunks))
+    # Chunks that are already well commented don't need Codex, so they stay as they are
+    uncommented = {chunk: chunk for chunk in unique_chunks if not needs_processing(chunk)}
+    yield uncommented
+    unique_chunks = [chunk for chunk in unique_chunks if chunk not in uncommented]
+    # If asked to, comment all the chunks with one Batch API job instead
+    if batch:
+        yield dict(zip(unique_chunks, comment_chunks_in_batch_job(unique_chunks)))
+        return
+    # Group the distinct chunks into batches of up to BATCH_SIZE chunks, one API call per batch
+    batches = [unique_chunks[i:i + BATCH_SIZE] for i in range(0, len(unique_chunks), BATCH_SIZE)]
+    # Comment each batch on the shared worker threads, with up to MAX_CONCURRENCY API calls in flight at once.
+    # EXECUTOR.map yields each batch's results in order, as soon as that batch and all those before it are done.
+    for chunk_batch, commented_batch in zip(batches, EXECUTOR.map(comment_chunks, batches)):
+        yield dict(zip(chunk_batch, commented_batch))
+
+def comment_code_chunks(code, batch=False):
+    """
+    Comment code, given as a string, yielding each commented chunk in order as soon as it's ready
     """
     # Split code into chunks
     chunks = split_into_chunks(code)
-    # Comment each chunk
-    commented_chunks = [comment_chunk(chunk) for chunk in chunks]
-    # Return the joined chunks
-    return '\n'.join(commented_chunks)
+    commented = {}
+    next_chunk = 0
+    for commented_batch in comment_distinct_chunks(chunks, batch):
+        commented.update(commented_batch)
+        # Yield every chunk that's now been commented, in order, stopping at the first that hasn't
+        while next_chunk < len(chunks) and chunks[next_chunk] in commented:
+            yield commented[chunks[next_chunk]]
+            next_chunk += 1
+
+def comment_code(code):
+    """
+    Comment code, given as a string.
+    """
+    # Return the joined commented chunks
+    return '\n'.join(comment_code_chunks(code))
+
+def write_new_file(filename, commented_chunks):
+    """
+    Write commented chunks to filename's .new file, each as soon as it's ready
+    """
+    # Open a temporary file in the same directory as the new file, so it can be renamed into place
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(filename)), delete=False) as f:
+        try:
+            # Write each commented chunk to the file as soon as it's ready, instead of building up all the commented code first
+            for i, commented_chunk in enumerate(commented_chunks):
+                # Separate the chunks with newlines, like comment_code does
+                if i:
+                    f.write('\n')
+                f.write(commented_chunk)
+        # If anything goes wrong, don't leave the partial temporary file behind
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    # Replace the new file with the finished one all at once, so it's never left half written
+    os.replace(f.name, filename + '.new')
+    logger.info('Wrote %s.new', filename)
 
-def comment_code_from_file(filename):
+def comment_code_from_file(filename, batch=False):
     """
-    Comment code from a file, outputting to a .new file.
+    Comment code from a file, outputting to a .new file. If batch is set, use a single Batch API job.
     """
     # Read the code from the file
     code = read_code(filename)
-    # Comment the code
-    commented_code = comment_code(code)
-    # Open the new file
-    with open(filename + '.new', 'w') as f:
-        # Write the commented code to the file
-        f.write(commented_code)
+    # Write out the commented code
+    write_new_file(filename, comment_code_chunks(code, batch))
+
+def comment_code_from_files(filenames, batch=False):
+    """
+    Comment code from several files at once, outputting each to its own .new file.
+    If batch is set, use a single Batch API job for all of them.
+    """
+    # Read and split every file first
+    file_chunks = [split_into_chunks(read_code(filename)) for filename in filenames]
+    # Comment all the files' chunks together, so they share batches, and each distinct chunk is only
+    # commented once even if it's copied into several files
+    commented = {}
+    for commented_batch in comment_distinct_chunks([chunk for chunks in file_chunks for chunk in chunks], batch):
+        commented.update(commented_batch)
+    # Write out each file's commented code
+    for filename, chunks in zip(filenames, file_chunks):
+        write_new_file(filename, (commented[chunk] for chunk in chunks))
 
 def comment_code_from_stdin():
     """
@@ -141,17 +686,61 @@ def comment_code_from_stdin():
     """
     # Read code from stdin
     code = read_code(None)
-    # Comment code
-    commented_code = comment_code(code)
-    # Print commented code
-    print(commented_code)
+    # Print each commented chunk as soon as it's ready, instead of waiting for all the commented code
+    for i, commented_chunk in enumerate(comment_code_chunks(code)):
+        # Separate the chunks with newlines, like comment_code does
+        if i:
+            sys.stdout.write('\n')
+        sys.stdout.write(commented_chunk)
+        sys.stdout.flush()
+    # End with a newline, like print does
+    sys.stdout.write('\n')
 
 if __name__ == '__main__':
-    # If there is only one argument
-    if len(sys.argv) == 1:
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description='Automatically add inline code comments with OpenAI Codex')
+    parser.add_argument('filenames', nargs='*', metavar='filename',
+                        help='files to comment, writing the commented code to filename.new (default: comment stdin to stdout)')
+    parser.add_argument('--batch', action='store_true',
+                        help='comment the files with one OpenAI Batch API job: half the cost, but can take up to 24 hours')
+    parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENCY,
+                        help='maximum number of API calls to have in flight at once (default: %(default)s)')
+    parser.add_argument('--prompts-per-request', type=int, default=BATCH_SIZE,
+                        help='maximum number of chunks to send in each API call (default: %(default)s)')
+    parser.add_argument('--max-requests-per-minute', type=int,
+                        help="OpenAI requests per minute rate limit to stay under (default: the account's limit, "
+                             "as reported by the API, starting at %s)" % MAX_REQUESTS_PER_MINUTE)
+    parser.add_argument('--max-tokens-per-minute', type=int,
+                        help="OpenAI tokens per minute rate limit to stay under (default: the account's limit, "
+                             "as reported by the API, starting at %s)" % MAX_TOKENS_PER_MINUTE)
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the response cache in %s" % CACHE_DIR)
+    parser.add_argument('-v', '--verbose', action='store_true', help='also log each API request to stderr')
+    args = parser.parse_args()
+    # Use as many worker threads as asked for, with a pooled connection for each of them
+    MAX_CONCURRENCY = args.max_concurrency
+    SESSION.mount('https://', make_adapter(MAX_CONCURRENCY))
+    EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+    # Send as many chunks per API call as asked for
+    BATCH_SIZE = args.prompts_per_request
+    # Pace the API calls to the account's rate limits
+    LIMITER = RateLimiter(args.max_requests_per_minute, args.max_tokens_per_minute)
+    # Call the API for every chunk if asked to, instead of reusing cached responses
+    CACHE = LLMCache(CACHE_DIR, enabled=not args.no_cache)
+    # Log progress messages to stderr, and the API requests too if asked to
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+    # If there are no filenames
+    if not args.filenames:
+        # Batch jobs are only for files, since they can take so long
+        if args.batch:
+            parser.error('--batch needs a filename')
         # Call the function to comment code from stdin
         comment_code_from_stdin()
-    # If there is more than one argument
-    else:
+    # If there is one filename
+    elif len(args.filenames) == 1:
         # Call the function to comment code from file
-        comment_code_from_file(sys.argv[1])
+        comment_code_from_file(args.filenames[0], args.batch)
+    # If there are several filenames
+    else:
+        # Call the function to comment all the files at once
+        comment_code_from_files(args.filenames, args.batch)
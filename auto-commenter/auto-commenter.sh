@@ -23,8 +23,8 @@ fi
 # realpath doesn't exist on linux. Do it cross-platform.
 file=$(cd "$(dirname "$1")"; pwd)/$(basename "$1")
 
-# Run auto-commenter.py to prompt OpenAI Codex add comments to $file
-python3 auto-commenter.py $file
+# Run auto-commenter.py to prompt OpenAI Codex add comments to $file, passing along any other options (such as --batch)
+python3 "$(dirname "$0")/auto-commenter.py" $file "${@:2}"
 # Write out a patch file containing all the changes Codex suggested
 diff -U 0 $file $file.new > $file.patch
 # Keep the patch file header
@@ -49,7 +49,7 @@ Functions called by main:
     Read in the code to be processed from a provided filename or from stdin.
 
 - get_code_chunks
-    Split the code into chunks beginning with each function definition line.
+    Split the code into chunks, one for each top-level function, including its decorators.
 
 - get_prompt
     Construct a Codex prompt consisting of:
@@ -57,8 +57,8 @@ Functions called by main:
     - the code chunk
     - the line '#autodoc: A comprehensive PEP 257 Google style doctring, including a brief one-line summary of the function.'.
 
-- get_response
-    Call the Codex API with the constructed prompt using the user’s GTP_API_KEY. API calls look like:
+- get_responses
+    Call the Codex API with a batch of constructed prompts using the user’s GTP_API_KEY. API calls look like:
 
     ```
     data = json.dumps({
@@ -90,14 +90,271 @@ Functions called by main:
 
 """
 
+import argparse
+import ast
+import glob
+import hashlib
+import io
 import json
+import logging
 import os
-import re
+import random
 import requests
 import sys
+import tempfile
+import threading
+import time
+import tokenize
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson encodes and decodes JSON several times faster than the json module, so use it if it's installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 GPT_API_KEY = os.environ['GPT_API_KEY']
 
+# Progress and debugging messages go to stderr through logging, so they never mix with the documented code
+logger = logging.getLogger('auto-docstring')
+
+# Maximum number of Codex API requests to have in flight at once
+MAX_CONCURRENCY = 8
+# Maximum number of prompts to send in a single Codex API call
+BATCH_SIZE = 20
+# Range of the number of tokens Codex may generate for each prompt, which is sized to the function:
+# MAX_TOKENS_BASE plus MAX_TOKENS_PER_LINE for each line of the function, within MIN_TOKENS and MAX_TOKENS
+MIN_TOKENS = 128
+MAX_TOKENS = 2048
+MAX_TOKENS_BASE = 50
+MAX_TOKENS_PER_LINE = 3
+# Number of tokens MODEL can take in a prompt and its response together. Functions whose prompt and
+# response might not fit are skipped rather than sent into an error response
+MODEL_CONTEXT = 4096
+# With --chat, functions longer than this many characters are skipped, and the model may generate up to
+# CHAT_MAX_TOKENS tokens of JSON for each docstring, however short the function is
+MAX_CHUNK_LENGTH = 16000
+CHAT_MAX_TOKENS = 1024
+# Seconds to wait for the Codex API before giving up on a request
+REQUEST_TIMEOUT = 120
+
+# Maximum number of attempts for each API call, and the cap in seconds on the wait between attempts
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 60
+# HTTP status codes worth retrying: rate limited (429), or a transient server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# OpenAI account rate limits to stay under, in requests per minute and tokens per minute
+MAX_REQUESTS_PER_MINUTE = 3500
+MAX_TOKENS_PER_MINUTE = 90000
+
+# davinci-codex has been retired, so use its replacement on the same completions API
+API_URL = 'https://api.openai.com/v1/completions'
+JSON_HEADERS = {'Content-Type': 'application/json'}
+MODEL = 'gpt-3.5-turbo-instruct'
+# With --chat, use the chat completions API instead, asking for the docstring's contents as JSON matching
+# DOCSTRING_SCHEMA, and formatting the docstring locally rather than having the model rewrite the function
+CHAT_API_URL = 'https://api.openai.com/v1/chat/completions'
+CHAT_MODEL = 'gpt-4o-mini'
+CHAT_INSTRUCTIONS = ('Describe the Python function the user sends for a comprehensive PEP 257 Google style docstring: '
+                     'a brief one-line summary of the function, a longer description of what it does, '
+                     'each of its arguments, and what it returns. '
+                     'Write them like the docstrings in these examples:\n\n')
+DOCSTRING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "description": {"type": "string"},
+        "args": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "type": {"type": "string"},
+                    "description": {"type": "string"}
+                },
+                "required": ["name", "type", "description"],
+                "additionalProperties": False
+            }
+        },
+        "returns": {
+            "type": "object",
+            "properties": {
+                "type": {"type": "string"},
+                "description": {"type": "string"}
+            },
+            "required": ["type", "description"],
+            "additionalProperties": False
+        }
+    },
+    "required": ["summary", "description", "args", "returns"],
+    "additionalProperties": False
+}
+# OpenAI Batch API endpoints, for running all the requests as one job at half the cost, within 24 hours
+FILES_URL = 'https://api.openai.com/v1/files'
+BATCHES_URL = 'https://api.openai.com/v1/batches'
+# Seconds to wait between checks on whether a batch job has finished
+BATCH_POLL_INTERVAL = 30
+# Each prompt is the example, the code chunk, and the instruction line, separated by blank lines
+PROMPT_TEMPLATE = '{example}\n\n{code_chunk}\n\n#autodoc: A comprehensive PEP 257 Google style doctring, including a brief one-line summary of the function.'
+# Directory to cache Codex responses in, so re-running on unchanged code doesn't call the API again
+CACHE_DIR = os.path.expanduser('~/.cache/auto-docstring')
+
+def make_adapter(pool_size):
+    """
+    Make an HTTPS adapter that keeps up to pool_size connections alive, and retries connections that
+    couldn't be made with exponential backoff. Only connect errors are retried here, before any of the
+    request was sent, so a POST is never sent twice without the rate limiter knowing; read errors,
+    timeouts, and error responses are all retried by post_with_retry.
+
+    Parameters:
+        pool_size (int): The number of connections to keep alive, one per worker thread.
+
+    Returns:
+        adapter (HTTPAdapter): The adapter, to mount on SESSION.
+
+    """
+    return HTTPAdapter(pool_maxsize=pool_size, max_retries=Retry(total=5, connect=5, read=0, status=0, backoff_factor=0.5))
+
+# Share one keep-alive connection pool across all API calls, so each call doesn't pay for its own
+# TCP and TLS handshake. The pool holds a connection per worker thread.
+SESSION = requests.Session()
+# Every API call is authenticated the same way, so set the header once for the whole session
+SESSION.headers['Authorization'] = 'Bearer {}'.format(GPT_API_KEY)
+SESSION.mount('https://', make_adapter(MAX_CONCURRENCY))
+
+class RateLimiter:
+    """
+    Token bucket rate limiter, to keep API calls under both a requests per minute and a tokens per minute limit.
+
+    Each bucket starts full and refills continuously at its per-minute rate. Each request takes one request
+    and its estimated number of tokens from the buckets, waiting until both have enough. Worker threads
+    share one RateLimiter.
+
+    Limits that aren't given start at MAX_REQUESTS_PER_MINUTE and MAX_TOKENS_PER_MINUTE, and are replaced
+    by the account's real limits once an API response reports them.
+
+    Parameters:
+        requests_per_minute (int): The maximum number of requests per minute, or None to use the account's limit.
+        tokens_per_minute (int): The maximum number of tokens per minute, or None to use the account's limit.
+
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.calibrate_requests = requests_per_minute is None
+        self.calibrate_tokens = tokens_per_minute is None
+        self.requests_per_minute = requests_per_minute or MAX_REQUESTS_PER_MINUTE
+        self.tokens_per_minute = tokens_per_minute or MAX_TOKENS_PER_MINUTE
+        self.available_requests = self.requests_per_minute
+        self.available_tokens = self.tokens_per_minute
+        self.last_update = time.monotonic()
+        # Time before which no requests should be sent at all, after the API has rate limited one
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Top up both buckets in proportion to the time since they were last topped up.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+
+        """
+        now = time.monotonic()
+        minutes = (now - self.last_update) / 60
+        self.last_update = now
+        self.available_requests = min(self.requests_per_minute, self.available_requests + minutes * self.requests_per_minute)
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + minutes * self.tokens_per_minute)
+
+    def acquire(self, tokens):
+        """
+        Wait until there is capacity for one more request using the given number of tokens, then take it.
+
+        Parameters:
+            tokens (int): The estimated number of tokens the request will use.
+
+        Returns:
+            None
+
+        """
+        # A request bigger than the whole token bucket would never fit, so just wait for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self.refill()
+                pause = self.paused_until - time.monotonic()
+                if pause <= 0 and self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(pause, (1 - self.available_requests) / self.requests_per_minute * 60,
+                           (tokens - self.available_tokens) / self.tokens_per_minute * 60)
+            time.sleep(wait)
+
+    def calibrate(self, headers):
+        """
+        Switch to the account's real rate limits, from the x-ratelimit-limit-* headers of an API response.
+
+        Only the limits that weren't given explicitly are changed. Responses without the headers leave
+        the limits as they were.
+
+        Parameters:
+            headers (dict): The API response's headers.
+
+        Returns:
+            None
+
+        """
+        with self.lock:
+            # The old rates applied until now
+            self.refill()
+            try:
+                if self.calibrate_requests:
+                    self.requests_per_minute = int(headers['x-ratelimit-limit-requests'])
+                if self.calibrate_tokens:
+                    self.tokens_per_minute = int(headers['x-ratelimit-limit-tokens'])
+            except (KeyError, ValueError):
+                pass
+            self.available_requests = min(self.available_requests, self.requests_per_minute)
+            self.available_tokens = min(self.available_tokens, self.tokens_per_minute)
+
+    def pause(self, seconds):
+        """
+        Hold back all requests for a while, once the API has rate limited one of them.
+
+        Parameters:
+            seconds (float): How long to hold requests back for.
+
+        Returns:
+            None
+
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def refund(self, tokens):
+        """
+        Give back tokens that were estimated but not used, once a request's actual usage is known.
+
+        Parameters:
+            tokens (int): The number of tokens to give back, or to take if negative.
+
+        Returns:
+            None
+
+        """
+        with self.lock:
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + tokens)
+
+# Pace all API calls to stay under the account's rate limits, rather than relying on retrying 429s
+LIMITER = RateLimiter()
+
 def get_api_key():
     """
     Get the user’s GTP_API_KEY from the environment.
@@ -111,46 +368,213 @@ def get_api_key():
     """
     return GPT_API_KEY
 
-def get_code():
+def get_code(filename):
     """
     Read in the code to be processed from a provided filename or from stdin.
 
     Parameters:
-        None
+        filename (str): The file to read, or None to read stdin.
 
     Returns:
         code (str): The code to be processed.
 
     """
-    if len(sys.argv) > 1:
-        with open(sys.argv[1]) as f:
+    if filename:
+        with open(filename) as f:
             code = f.read()
     else:
         code = sys.stdin.read()
     return code
 
+def get_filenames(paths):
+    """
+    Expand the files and directories to process into a list of files, with each directory replaced
+    by the Python files anywhere under it.
+
+    Parameters:
+        paths (list): The files and directories given on the command line.
+
+    Returns:
+        filenames (list): The files to process.
+
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, '**', '*.py'), recursive=True)))
+        else:
+            filenames.append(path)
+    return filenames
+
+def split_lines(code):
+    """
+    Split code into lines the way ast numbers them, only at newlines, carriage returns, and CRLFs, so a node's
+    line numbers index into the result. Unlike str.splitlines, form feeds and other separators don't end a line.
+
+    Parameters:
+        code (str): The code to split.
+
+    Returns:
+        lines (list): The lines, each with its own line ending, so ''.join(lines) is the code.
+
+    """
+    return io.StringIO(code, newline='').readlines()
+
+def parses(code):
+    """
+    Check whether code parses as Python.
+
+    Parameters:
+        code (str): The code to check.
+
+    Returns:
+        parses (bool): True if ast can parse the code.
+
+    """
+    try:
+        ast.parse(code)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
 def get_code_chunks(code):
     """
-    Split the code into chunks beginning with each function definition line.
+    Split the code into chunks, one for each top-level function, including its decorators.
+
+    The code is parsed once, and sliced into parts at the start and end lines of each function, so the
+    code between functions is kept as parts too, and the code can be put back together with ''.join(parts).
+    Code that can't be parsed is split on blank lines by get_code_chunks_by_blank_lines instead.
 
     Parameters:
         code (str): The code to be processed.
 
     Returns:
-        chunks (list): The code split into chunks beginning with each function definition line.
+        parts (list): The functions and the code between them, in order.
+        positions (list): The index in parts of each function.
 
     """
-    chunks = []
-    for chunk in code.split('\n\n'):
-        #print("Chunk:\n",chunk)
-        if re.match(r'\s*\n*def ', chunk):
-        # If the function definition line is indented (starts with whitespace), skip it.
-            if re.match(r'\s+def ', chunk):
-                pass
-            else:
-                chunks.append(chunk)
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return get_code_chunks_by_blank_lines(code)
+    lines = split_lines(code)
+    parts = []
+    positions = []
+    end = 0
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list]) - 1
+        # The code since the last function, then the function itself
+        parts.append(''.join(lines[end:start]))
+        positions.append(len(parts))
+        parts.append(''.join(lines[start:node.end_lineno]))
+        end = node.end_lineno
+    parts.append(''.join(lines[end:]))
+    return parts, positions
+
+def get_code_chunks_by_blank_lines(code):
+    """
+    Split code that can't be parsed into chunks beginning with each function definition line.
 
-    return chunks
+    The code is split on blank lines into parts, and the chunks are the parts that begin with a
+    function definition line. The blank lines are kept at the end of each part, so the code can be
+    put back together with ''.join(parts).
+
+    Parameters:
+        code (str): The code to be processed.
+
+    Returns:
+        parts (list): The code split on blank lines.
+        positions (list): The index in parts of each chunk beginning with a function definition line.
+
+    """
+    parts = code.split('\n\n')
+    parts = [part + '\n\n' for part in parts[:-1]] + parts[-1:]
+    positions = []
+    for i, chunk in enumerate(parts):
+        # Keep chunks that start with a function definition line. If the function definition line
+        # is indented (starts with whitespace), skip it. A plain prefix check does this without
+        # running a regex over every chunk.
+        if chunk.startswith('def '):
+            positions.append(i)
+
+    return parts, positions
+
+@lru_cache(maxsize=1)
+def _example():
+    """
+    Read in the contents of autodocstring-example.txt, only once however many prompts use it.
+
+    The example is read from the script's own directory, so the script can be run from anywhere.
+
+    Parameters:
+        None
+
+    Returns:
+        example (str): The example prompt text.
+
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autodocstring-example.txt')) as f:
+        return f.read()
+
+@lru_cache(maxsize=1)
+def _chat_instructions():
+    """
+    Build the chat completions API's system message: the instructions followed by the examples
+    in autodocstring-example.txt.
+
+    The system message comes first and is byte-identical in every request, with only the function
+    after it, so the API's prompt cache can reuse the shared prefix across calls.
+
+    Parameters:
+        None
+
+    Returns:
+        instructions (str): The system message.
+
+    """
+    return CHAT_INSTRUCTIONS + _example()
+
+def needs_processing(code_chunk):
+    """
+    Check whether a function still needs a docstring.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+
+    Returns:
+        needed (bool): False if the function already has a non-empty docstring, otherwise True.
+
+    """
+    try:
+        function = ast.parse(code_chunk).body[0]
+    # If the chunk can't be parsed on its own, let Codex document it
+    except (SyntaxError, ValueError, IndexError):
+        return True
+    if not isinstance(function, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return True
+    return not ast.get_docstring(function)
+
+def is_one_liner(code_chunk):
+    """
+    Check whether a function is defined all on one line, with its body after the colon, which leaves
+    nowhere to put a docstring without rewriting the function.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+
+    Returns:
+        one_liner (bool): True if the function's body starts on the line its definition ends on.
+
+    """
+    try:
+        function = ast.parse(code_chunk).body[0]
+    except (SyntaxError, ValueError, IndexError):
+        return False
+    if not isinstance(function, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return False
+    return function.body[0].lineno <= definition_end(code_chunk, function)
 
 def get_prompt(code_chunk):
     """
@@ -166,63 +590,670 @@ def get_prompt(code_chunk):
         prompt (str): A prompt for the user.
 
     """
-    #print(code_chunk.split('\n')[0])
-    prompt = '\n\n'.join([
-        open('autodocstring-example.txt').read(),
-        code_chunk,
-        '#autodoc: A comprehensive PEP 257 Google style doctring, including a brief one-line summary of the function.',
-    ])
+    # The example comes first and is identical in every prompt, with only the chunk-specific text
+    # after it, so the API's prompt cache can reuse the shared prefix across calls
+    # The template separates the chunk from the instruction line itself, so drop the chunk's own trailing newlines
+    prompt = PROMPT_TEMPLATE.format(example=_example(), code_chunk=code_chunk.rstrip('\n'))
     return prompt
 
-def get_response(prompt):
+def json_dumps(obj):
     """
-    Call the Codex API with the constructed prompt using the user’s GTP_API_KEY. API calls look like:
+    Encode an object as JSON, using orjson if it's installed.
 
-    ```
-    data = json.dumps({
+    Parameters:
+        obj: The object to encode.
+
+    Returns:
+        data (bytes): The JSON encoded object.
+
+    """
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+def json_loads(data):
+    """
+    Decode JSON, using orjson if it's installed.
+
+    Parameters:
+        data (bytes): The JSON to decode.
+
+    Returns:
+        obj: The decoded object.
+
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def get_max_tokens(code_chunk):
+    """
+    Size the number of tokens Codex may generate for a function to the function, so small functions
+    don't hold rate limit capacity for tokens they'll never use, and large ones aren't cut off.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+
+    Returns:
+        max_tokens (int): The most tokens to let Codex generate for the function.
+
+    """
+    lines = code_chunk.rstrip('\n').count('\n') + 1
+    return min(max(MAX_TOKENS_BASE + MAX_TOKENS_PER_LINE * lines, MIN_TOKENS), MAX_TOKENS)
+
+def fits_context(code_chunk, chat=False):
+    """
+    Check whether a function is short enough to send: with --chat, under MAX_CHUNK_LENGTH characters,
+    and otherwise, with its prompt and the most tokens Codex may generate for it fitting in MODEL_CONTEXT.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+        chat (bool): Whether the function is for the chat completions API.
+
+    Returns:
+        fits (bool): True if the function can be sent.
+
+    """
+    if chat:
+        return len(code_chunk) <= MAX_CHUNK_LENGTH
+    return estimate_tokens(get_prompt(code_chunk)) + get_max_tokens(code_chunk) <= MODEL_CONTEXT
+
+def estimate_tokens(text):
+    """
+    Roughly estimate the number of tokens in text, at about 4 characters per token.
+
+    Parameters:
+        text (str): The text to estimate.
+
+    Returns:
+        tokens (int): The estimated number of tokens.
+
+    """
+    return len(text) // 4 + 1
+
+def post_with_retry(data, tokens, url=API_URL):
+    """
+    POST a request to the Codex API, retrying rate limit (429) and server (5xx) errors, timeouts, and dropped connections.
+
+    Waits as long as the API's Retry-After header asks between attempts, or otherwise a random time
+    of up to 2**attempt seconds (capped at MAX_BACKOFF), so that concurrent requests that were rate
+    limited together don't all retry together. A 429 pauses every request through LIMITER, not just this one.
+
+    Parameters:
+        data (bytes): The JSON encoded request body.
+        tokens (int): The estimated number of tokens the request will use, for the rate limiter.
+        url (str): The API endpoint to POST to.
+
+    Returns:
+        response (requests.Response): The first response that isn't worth retrying, or the last
+            response once MAX_ATTEMPTS is reached.
+
+    Raises:
+        requests.exceptions.ConnectionError, requests.exceptions.Timeout: If the last attempt failed
+            without a response.
+
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        LIMITER.acquire(tokens)
+        try:
+            response = SESSION.post(url, headers=JSON_HEADERS, data=data, timeout=REQUEST_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            wait = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+            logger.warning('Codex API call failed (%s), retrying in %.1fs', e, wait)
+            time.sleep(wait)
+            continue
+        LIMITER.calibrate(response.headers)
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+            return response
+        try:
+            wait = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            wait = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+        logger.warning('Codex API returned %s, retrying in %.1fs', response.status_code, wait)
+        # Once one request hits the rate limit they all will, so hold them all back, not just this one
+        if response.status_code == 429:
+            LIMITER.pause(wait)
+        else:
+            time.sleep(wait)
+
+class LLMCache:
+    """
+    On-disk cache of Codex responses, keyed by a hash of the request that got them.
+
+    Each response is stored in its own file, sharded into subdirectories by the first two hex digits of its key.
+
+    Parameters:
+        directory (str): The directory to store the responses in.
+        enabled (bool): Whether to read and write the cache at all.
+
+    """
+    def __init__(self, directory, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+
+    def key(self, payload):
+        """
+        Hash a single-prompt API request into the key to cache its response under.
+
+        At temperature 0, the same prompt and parameters sent to the same model always get the same response.
+
+        Parameters:
+            payload (dict): The request body, with a single prompt.
+
+        Returns:
+            key (str): The SHA-256 hex digest of the API URL and the request body, or None if the cache is
+                disabled or the request isn't at temperature 0.
+
+        """
+        if not self.enabled or payload.get('temperature') != 0:
+            return None
+        return hashlib.sha256((API_URL + json.dumps(payload, sort_keys=True)).encode()).hexdigest()
+
+    def path(self, key):
+        """
+        Get the file a response is cached in.
+
+        Parameters:
+            key (str): The cache key.
+
+        Returns:
+            path (str): The path of the cache file.
+
+        """
+        return os.path.join(self.directory, key[:2], key + '.txt')
+
+    def get(self, key):
+        """
+        Get a cached response.
+
+        Parameters:
+            key (str): The cache key, from key.
+
+        Returns:
+            text (str): The cached response text, or None if it hasn't been cached.
+
+        """
+        if key is None:
+            return None
+        try:
+            with open(self.path(key)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, text):
+        """
+        Cache a response.
+
+        Parameters:
+            key (str): The cache key, from key.
+            text (str): The response text.
+
+        Returns:
+            None
+
+        """
+        if key is None:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename it into place, so concurrent readers never see a half written response
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as f:
+            f.write(text)
+        os.replace(f.name, path)
+
+CACHE = LLMCache(CACHE_DIR)
+
+def get_payload(prompt, max_tokens=MAX_TOKENS):
+    """
+    Build the API request body for a prompt.
+
+    Parameters:
+        prompt (str or list): The prompt, or a list of prompts to send in a single API call.
+        max_tokens (int): The most tokens Codex may generate for each prompt.
+
+    Returns:
+        payload (dict): The request body.
+
+    """
+    return {
+        "model": MODEL,
         "prompt": prompt,
-        "max_tokens": 1500,
+        "max_tokens": max_tokens,
         "temperature": 0,
         "stop": "#autodoc"
-    })
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': 'Bearer {}'.format(GPT_API_KEY)
     }
-    response = requests.post('https://api.openai.com/v1/engines/davinci-codex/completions', headers=headers, data=data)
-    ```
 
-    The response is json, and the output we want is in ['choices'][0]['text'].
+def get_responses(prompts, max_tokens):
+    """
+    Call the Codex API with a batch of constructed prompts using the user’s GTP_API_KEY.
+
+    The completions endpoint accepts a list of prompts, and returns one choice per prompt,
+    with each choice's index giving the position of the prompt it completes. Prompts whose
+    responses are already cached aren't sent, and new responses are cached. If the API rejects
+    the list, as models that only take one prompt per request do, the prompts are sent one at a time.
 
     Parameters:
-        prompt (str): A prompt for the user.
+        prompts (list): The prompts to send in a single API call.
+        max_tokens (list): The most tokens Codex may generate for each prompt. A single API call
+            has a single limit for all of its prompts, so the largest is used.
 
     Returns:
-        response (str): The response from the API.
+        responses (list): The response text for each prompt, in the same order as prompts,
+            or None for each prompt that wasn't cached if the API call failed.
 
     """
-    data = json.dumps({
-        "prompt": prompt,
-        "max_tokens": 1500,
+    keys = [CACHE.key(get_payload(prompt, limit)) for prompt, limit in zip(prompts, max_tokens)]
+    responses = [CACHE.get(key) for key in keys]
+    missing = [i for i, response in enumerate(responses) if response is None]
+    if not missing:
+        return responses
+    limit = max(max_tokens[i] for i in missing)
+    # A single API call has a single limit for all of its prompts, so send any prompt that wouldn't fit in
+    # the model's context with that limit on its own, with just its own limit
+    crowded = [i for i in missing if estimate_tokens(prompts[i]) + limit > MODEL_CONTEXT]
+    while crowded and len(missing) > 1:
+        for i in crowded:
+            responses[i] = get_responses([prompts[i]], [max_tokens[i]])[0]
+        missing = [i for i in missing if i not in crowded]
+        if not missing:
+            return responses
+        limit = max(max_tokens[i] for i in missing)
+        crowded = [i for i in missing if estimate_tokens(prompts[i]) + limit > MODEL_CONTEXT]
+    # Send a single prompt on its own rather than as a list, which every model accepts
+    if len(missing) == 1:
+        data = json_dumps(get_payload(prompts[missing[0]], limit))
+    else:
+        data = json_dumps(get_payload([prompts[i] for i in missing], limit))
+    # Rate limits count each prompt's tokens plus the most tokens it could generate
+    tokens = sum(estimate_tokens(prompts[i]) + limit for i in missing)
+    try:
+        response = post_with_retry(data, tokens)
+        result = json_loads(response.content)
+    # If the call still failed after retrying, leave these functions undocumented rather than losing the whole file
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error('Codex API call failed: %s', e)
+        return responses
+    if response.status_code == 400 and len(missing) > 1:
+        logger.warning('Codex API rejected %s prompts in one request, sending them one at a time: %s', len(missing), result)
+        for i in missing:
+            responses[i] = get_responses([prompts[i]], [max_tokens[i]])[0]
+        return responses
+    # Read the whole response before using any of it, so an error response or a malformed one
+    # leaves these functions undocumented instead of putting something that isn't text into the code
+    try:
+        # Each choice's index is the position of its prompt among the missing ones
+        texts = {missing[choice['index']]: (choice['text'], choice.get('finish_reason')) for choice in result['choices']}
+        used = result['usage']['total_tokens']
+    except (KeyError, IndexError, TypeError):
+        logger.error('Unexpected Codex API response (HTTP %s): %s', response.status_code, result)
+        return responses
+    # Give back whatever part of the estimate the call didn't really use
+    LIMITER.refund(tokens - used)
+    for i, (text, finish_reason) in texts.items():
+        # A response cut off at max_tokens may have stopped partway through the docstring, so don't use or cache it
+        if finish_reason == 'length':
+            logger.warning('Codex ran out of tokens documenting a function, leaving it as it was')
+            continue
+        if not isinstance(text, str):
+            logger.error('Unexpected Codex API response text: %s', text)
+            continue
+        responses[i] = text
+        CACHE.set(keys[i], text)
+    return responses
+
+
+def get_chat_payload(code_chunk):
+    """
+    Build the chat completions API request body asking for a function's docstring as JSON.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+
+    Returns:
+        payload (dict): The request body.
+
+    """
+    return {
+        "model": CHAT_MODEL,
+        "messages": [
+            {"role": "system", "content": _chat_instructions()},
+            {"role": "user", "content": code_chunk.rstrip('\n')}
+        ],
+        "max_tokens": CHAT_MAX_TOKENS,
         "temperature": 0,
-        "stop": "#autodoc"
-    })
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': 'Bearer {}'.format(GPT_API_KEY)
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "docstring", "strict": True, "schema": DOCSTRING_SCHEMA}
+        }
     }
-    response = requests.post('https://api.openai.com/v1/engines/davinci-codex/completions', headers=headers, data=data)
+
+def get_chat_response(code_chunk):
+    """
+    Call the chat completions API for the contents of a function's docstring, as JSON matching DOCSTRING_SCHEMA.
+
+    A cached response is used if there is one, and a new response is cached.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+
+    Returns:
+        response (str): The JSON response text, or None if the API call failed.
+
+    """
+    payload = get_chat_payload(code_chunk)
+    key = CACHE.key(payload)
+    response_text = CACHE.get(key)
+    if response_text is not None:
+        return response_text
+    # Rate limits count the prompt's tokens plus the most tokens it could generate
+    tokens = estimate_tokens(_chat_instructions() + code_chunk) + payload['max_tokens']
+    try:
+        result = json_loads(post_with_retry(json_dumps(payload), tokens, CHAT_API_URL).content)
+    # If the call still failed after retrying, leave this function undocumented rather than losing the whole file
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error('Chat completions API call failed: %s', e)
+        return None
+    try:
+        response_text = result['choices'][0]['message']['content']
+        finish_reason = result['choices'][0].get('finish_reason')
+        used = result['usage']['total_tokens']
+    except (KeyError, IndexError, TypeError, AttributeError):
+        logger.error('Unexpected chat completions API response: %s', result)
+        return None
+    LIMITER.refund(tokens - used)
+    # JSON cut off at max_tokens can't be parsed, so don't cache it
+    if finish_reason == 'length':
+        logger.warning('The model ran out of tokens documenting a function, leaving it as it was')
+        return None
+    # The model refused, so there's no docstring to cache
+    if not isinstance(response_text, str):
+        return None
+    CACHE.set(key, response_text)
+    return response_text
+
+def choice_text(choice):
+    """
+    Get the generated text from a choice in a completions or chat completions API response.
+
+    Parameters:
+        choice (dict): The choice.
+
+    Returns:
+        text (str): The choice's text, or its message's content for chat completions.
+
+    """
+    if 'message' in choice:
+        return choice['message']['content']
+    return choice['text']
+
+def submit_batch(payloads, url=API_URL):
+    """
+    Submit API request bodies as a single OpenAI Batch API job.
+
+    Each request's custom_id is its position in payloads, so the results can be matched back up.
+
+    Parameters:
+        payloads (list): The request bodies, each with a single prompt.
+        url (str): The API endpoint the requests are for.
+
+    Returns:
+        batch_id (str): The id of the batch job.
+
+    """
+    endpoint = urllib.parse.urlsplit(url).path
+    lines = [
+        json_dumps({"custom_id": str(i), "method": "POST", "url": endpoint, "body": payload})
+        for i, payload in enumerate(payloads)
+    ]
+    response = SESSION.post(FILES_URL, data={'purpose': 'batch'},
+                            files={'file': ('batch.jsonl', b'\n'.join(lines))}, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    input_file_id = json_loads(response.content)['id']
+    data = json_dumps({"input_file_id": input_file_id, "endpoint": endpoint, "completion_window": "24h"})
+    response = SESSION.post(BATCHES_URL, headers=JSON_HEADERS, data=data, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return json_loads(response.content)['id']
+
+def wait_for_batch(batch_id):
+    """
+    Wait for a Batch API job to finish, checking on it every BATCH_POLL_INTERVAL seconds.
+
+    Parameters:
+        batch_id (str): The id of the batch job.
+
+    Returns:
+        batch (dict): The finished batch job, whether it completed, failed, expired, or was cancelled.
+
+    """
+    while True:
+        response = SESSION.get('{}/{}'.format(BATCHES_URL, batch_id), timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        batch = json_loads(response.content)
+        if batch['status'] in ('completed', 'failed', 'expired', 'cancelled'):
+            return batch
+        logger.info('Batch %s is %s, checking again in %ss', batch_id, batch['status'], BATCH_POLL_INTERVAL)
+        time.sleep(BATCH_POLL_INTERVAL)
+
+def get_batch_results(batch):
+    """
+    Download a finished Batch API job's results.
+
+    Parameters:
+        batch (dict): The finished batch job.
+
+    Returns:
+        results (dict): The response text of each request that succeeded, keyed by its custom_id.
+
+    """
+    results = {}
+    # A job where no requests succeeded has no output file
+    if not batch.get('output_file_id'):
+        return results
+    response = SESSION.get('{}/{}/content'.format(FILES_URL, batch['output_file_id']), timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    for line in response.content.splitlines():
+        result = json_loads(line)
+        if not result['response'] or result['response']['status_code'] != 200:
+            continue
+        # Leave out any request whose response isn't text, or was cut off at max_tokens, the same as one that failed
+        try:
+            choice = result['response']['body']['choices'][0]
+            text = choice_text(choice)
+        except (KeyError, IndexError, TypeError):
+            text = None
+        if isinstance(text, str) and choice.get('finish_reason') == 'length':
+            logger.warning('Ran out of tokens documenting a function, leaving it as it was')
+        elif isinstance(text, str):
+            results[result['custom_id']] = text
+        else:
+            logger.error('Unexpected Batch API response: %s', result['response']['body'])
+    return results
+
+def get_responses_in_batch_job(payloads, url=API_URL):
+    """
+    Get the responses to API requests with a single Batch API job, which costs half as much as individual
+    API calls but can take up to 24 hours. Requests whose responses are already cached aren't sent,
+    and new responses are cached.
+
+    Parameters:
+        payloads (list): The request bodies, each with a single prompt.
+        url (str): The API endpoint the requests are for.
+
+    Returns:
+        responses (list): The response text for each request, in the same order as payloads,
+            or None for each request that failed.
+
+    """
+    keys = [CACHE.key(payload) for payload in payloads]
+    responses = [CACHE.get(key) for key in keys]
+    missing = [i for i, response in enumerate(responses) if response is None]
+    if not missing:
+        return responses
+    batch_id = submit_batch([payloads[i] for i in missing], url)
+    logger.info('Submitted batch %s of %s requests', batch_id, len(missing))
+    batch = wait_for_batch(batch_id)
+    results = get_batch_results(batch)
+    logger.info('Batch %s %s with %s of %s requests succeeded', batch_id, batch['status'], len(results), len(missing))
+    # Each result's custom_id is the position of its request among the missing ones
+    for j, i in enumerate(missing):
+        if str(j) in results:
+            responses[i] = results[str(j)]
+            CACHE.set(keys[i], results[str(j)])
+    return responses
+
+
+def format_docstring(fields, indent):
+    """
+    Format the contents of a docstring as a PEP 257 Google style docstring.
+
+    Parameters:
+        fields (dict): The docstring's contents, matching DOCSTRING_SCHEMA.
+        indent (str): The indentation of the function's body.
+
+    Returns:
+        docstring (str): The docstring's lines, indented to go at the start of the function's body.
+
+    """
+    lines = [fields['summary'].strip(), '']
+    if fields['description'].strip():
+        lines.extend(fields['description'].strip().splitlines())
+        lines.append('')
+    if fields['args']:
+        lines.append('Args:')
+        for arg in fields['args']:
+            lines.append('    {} ({}): {}'.format(arg['name'], arg['type'], arg['description'].strip()))
+        lines.append('')
+    lines.append('Returns:')
+    if fields['returns']['description'].strip():
+        lines.append('    {}: {}'.format(fields['returns']['type'], fields['returns']['description'].strip()))
+    else:
+        lines.append('    ' + fields['returns']['type'])
+    # Don't let backslashes or triple quotes in the text change or end the docstring
+    lines = [line.replace('\\', '\\\\').replace('"""', '\\"\\"\\"') for line in lines]
+    # and a quote at the end of the text, which would run into the closing quotes if they shared its line
+    if lines[-1].endswith('"'):
+        lines[-1] = lines[-1][:-1] + '\\"'
+    lines[0] = '"""' + lines[0]
+    lines.append('"""')
+    return ''.join(indent + line + '\n' if line.strip() else '\n' for line in lines)
+
+def insert_docstring(code_chunk, response_text):
+    """
+    Put a docstring into a function, replacing any docstring it already has.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+        response_text (str): The docstring's contents, as JSON matching DOCSTRING_SCHEMA.
+
+    Returns:
+        new_chunk (str): The function with the docstring, or None if the function or the response
+            couldn't be parsed, or the function is all on one line.
+
+    """
+    try:
+        fields = json_loads(response_text)
+        function = ast.parse(code_chunk).body[0]
+    except (SyntaxError, ValueError, IndexError):
+        return None
+    if not isinstance(function, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return None
+    lines = split_lines(code_chunk)
+    header_end = definition_end(code_chunk, function)
+    first = function.body[0]
+    if first.lineno <= header_end:
+        return None
+    indent = lines[first.lineno - 1][:first.col_offset]
+    if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+        start = first.end_lineno
+    else:
+        start = header_end
+    return ''.join(lines[:header_end]) + format_docstring(fields, indent) + ''.join(lines[start:])
+
+def function_header(code_chunk):
+    """
+    Returns the function's own definition, with any decorators and every line of its signature, so they
+    can be kept exactly as they were rather than taken from Codex's response.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+
+    Returns:
+        header (str): The lines up to the end of the definition, or None if no definition was found.
+
+    """
+    try:
+        function = ast.parse(code_chunk).body[0]
+    except (SyntaxError, ValueError, IndexError):
+        function = None
+    if isinstance(function, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return ''.join(split_lines(code_chunk)[:definition_end(code_chunk, function)])
+    # For chunks that can't be parsed, the definition line is the one extract_function_code_by_text skips
+    start = len(code_chunk) - len(code_chunk.lstrip())
+    end = code_chunk.find('\n', start)
+    if code_chunk.startswith(('def ', 'async def '), start) and end != -1:
+        return code_chunk[:end + 1]
+    return None
+
+def body_indent(code_chunk):
+    """
+    Returns the indentation of the function's body, for the docstring to match.
+
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+
+    Returns:
+        indent (str): The whitespace before the function's first statement.
+
+    """
     try:
-        response = response.json()['choices'][0]['text']
-    except KeyError:
-        print(response.json(), file=sys.stderr)
-        #sys.exit(1)
-    return response
+        function = ast.parse(code_chunk).body[0]
+    except (SyntaxError, ValueError, IndexError):
+        function = None
+    if isinstance(function, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        first = function.body[0]
+        return split_lines(code_chunk)[first.lineno - 1][:first.col_offset]
+    # For chunks that can't be parsed, use the indentation of the first line of code after the definition
+    for line in split_lines(extract_function_code_by_text(code_chunk)):
+        if line.strip():
+            return line[:len(line) - len(line.lstrip())]
+    return '    '
+
+def extract_docstring(response, indent):
+    """
+    Returns only the docstring from Codex's response, without the function definition it starts with.
+
+    Parameters:
+        response (str): The response text, a function definition followed by its docstring.
+        indent (str): The indentation of the function's body, to indent the docstring with.
 
+    Returns:
+        docstring (str): The docstring's lines, or None if the response has no complete docstring.
+
+    """
+    opening = response.find('"""')
+    closing = response.find('"""', opening + 3) if opening != -1 else -1
+    if closing == -1:
+        return None
+    # Re-indent the docstring from Codex's indentation to the function's own, so it lines up with the body
+    line_start = response.rfind('\n', 0, opening) + 1
+    response_indent = response[line_start:opening]
+    lines = split_lines(response[opening:closing + 3])
+    if not response_indent.strip():
+        lines = lines[:1] + [indent + line[len(response_indent):] if line.startswith(response_indent) else line
+                             for line in lines[1:]]
+    return indent + ''.join(lines) + '\n'
 
 def extract_function_code(code_chunk):
     """
-    Returns only the code of the function, without the funciton definition line or the docstring
+    Returns only the code of the function, without the function definition or the docstring.
+
+    Parses the chunk to find where the definition and any docstring end, so definitions spanning
+    several lines, ''' quoted docstrings, and other strings containing triple quotes are all handled.
+    Chunks that can't be parsed, such as a function cut off at a blank line, are handled by
+    extract_function_code_by_text instead.
 
     Parameters:
         code_chunk (str): A chunk of code.
@@ -231,40 +1262,104 @@ def extract_function_code(code_chunk):
         function_code (str): The code of the function.
 
     """
-    # Remove the function definition line
-    #print(code_chunk)
-    function_code = re.sub(r'^\s*def .+\n', '', code_chunk)
-    # Split the function code by triple "s into a function chunks variable
-    function_chunks = re.split(r'\"\"\"', function_code)
-    # If the first chunk contains anything besides newlines and whitespace, return the function_code unchanged
-    if not re.match(r'^\s*$', function_chunks[0]):
-        print(function_chunks[0])
-        return function_code
-    #print(function_code)
-    # Remove the first docstring
-    function_code = re.sub(r'""".*?"""', '', function_code, 1, flags=re.DOTALL)
-    #function_code = re.sub(r'\):\n*\s*""".*?"""', '\):\n', function_code, flags=re.DOTALL)
+    try:
+        function = ast.parse(code_chunk).body[0]
+    except (SyntaxError, ValueError, IndexError):
+        return extract_function_code_by_text(code_chunk)
+    if not isinstance(function, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return extract_function_code_by_text(code_chunk)
+    first = function.body[0]
+    if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+        # Keep everything after the docstring
+        start = first.end_lineno
+    else:
+        # Keep everything after the definition, including any comments before the first statement
+        start = definition_end(code_chunk, function)
+        # A function all on one line has no code separate from its definition to keep
+        if first.lineno <= start:
+            return extract_function_code_by_text(code_chunk)
+    return ''.join(split_lines(code_chunk)[start:])
+
+def definition_end(code_chunk, function):
+    """
+    Find the line a function definition ends on, at the colon that closes its signature.
 
-    #print(function_code)
-    return function_code
+    Parameters:
+        code_chunk (str): A chunk of code starting with the function.
+        function (ast.FunctionDef): The function's parsed node.
+
+    Returns:
+        line (int): The 1-based number of the line the definition ends on.
 
+    """
+    depth = 0
+    for token in tokenize.generate_tokens(io.StringIO(code_chunk).readline):
+        # Skip any decorators
+        if token.type != tokenize.OP or token.start[0] < function.lineno:
+            continue
+        if token.string in '([{':
+            depth += 1
+        elif token.string in ')]}':
+            depth -= 1
+        # Colons inside brackets belong to annotations, default values, or slices
+        elif token.string == ':' and depth == 0:
+            return token.end[0]
+    return function.lineno
 
-def output_code(code):
+def extract_function_code_by_text(code_chunk):
+    """
+    Returns only the code of the function, without the function definition line or the docstring, for chunks that can't be parsed.
+
+    Scans the chunk once from the start with str.find, rather than making several regex passes over it.
+
+    Parameters:
+        code_chunk (str): A chunk of code.
+
+    Returns:
+        function_code (str): The code of the function.
+
+    """
+    # Skip the function definition line, if the chunk starts with one
+    start = len(code_chunk) - len(code_chunk.lstrip())
+    if code_chunk.startswith(('def ', 'async def '), start):
+        end = code_chunk.find('\n', start)
+        start = end + 1 if end != -1 else 0
+    else:
+        start = 0
+    # If anything besides newlines and whitespace comes before the first triple ", return the function code unchanged
+    opening = code_chunk.find('"""', start)
+    if opening == -1 or code_chunk[start:opening].strip():
+        logger.debug('Not removing docstring after: %s', code_chunk[start:opening])
+        return code_chunk[start:]
+    # Remove the first docstring, if it's closed
+    closing = code_chunk.find('"""', opening + 3)
+    if closing == -1:
+        return code_chunk[start:]
+    return code_chunk[start:opening] + code_chunk[closing + 3:]
+
+
+def output_code(parts, filename):
     """
     If the script was called with a filename, output the commented code to a .new file. Otherwise output it to stdout.
 
+    The code is written out part by part, without joining it into one string first.
+
     Parameters:
-        code (str): The code to be processed.
+        parts (iterable): The parts of the processed code, in order.
+        filename (str): The file the code was read from, or None if it was read from stdin.
 
     Returns:
         None
 
     """
-    if len(sys.argv) > 1:
-        with open(sys.argv[1] + '.new', 'w') as f:
-            f.write(code)
+    if filename:
+        # Write to a temporary file in the same directory, then rename it into place, so the .new file
+        # is never left half written
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(filename)), delete=False) as f:
+            f.writelines(parts)
+        os.replace(f.name, filename + '.new')
     else:
-        print(code)
+        sys.stdout.writelines(parts)
 
 def main():
     """
@@ -277,33 +1372,135 @@ def main():
         None
 
     """
-    code = get_code()
-    chunks = get_code_chunks(code)
-    for chunk in chunks:
-        prompt = get_prompt(chunk)
-        #print(prompt)
-        try:
-            response = get_response(prompt)
-        except json.decoder.JSONDecodeError:
-            continue
-        # If the response is empty, continue to the next chunk
+    global MAX_CONCURRENCY, BATCH_SIZE, LIMITER, CACHE
+    parser = argparse.ArgumentParser(description='Automatically add PEP 257 Google style docstrings to Python code with OpenAI Codex')
+    parser.add_argument('filenames', nargs='*', metavar='filename',
+                        help='files, or directories of .py files, to document, writing the documented code to '
+                             'filename.new (default: document stdin to stdout)')
+    parser.add_argument('--batch', action='store_true',
+                        help='document the files with one OpenAI Batch API job: half the cost, but can take up to 24 hours')
+    parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENCY,
+                        help='maximum number of API calls to have in flight at once (default: %(default)s)')
+    parser.add_argument('--prompts-per-request', type=int, default=BATCH_SIZE,
+                        help='maximum number of functions to send in each API call (default: %(default)s)')
+    parser.add_argument('--max-requests-per-minute', type=int,
+                        help="OpenAI requests per minute rate limit to stay under (default: the account's limit, "
+                             "as reported by the API, starting at %s)" % MAX_REQUESTS_PER_MINUTE)
+    parser.add_argument('--max-tokens-per-minute', type=int,
+                        help="OpenAI tokens per minute rate limit to stay under (default: the account's limit, "
+                             "as reported by the API, starting at %s)" % MAX_TOKENS_PER_MINUTE)
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the response cache in %s" % CACHE_DIR)
+    parser.add_argument('--force', action='store_true',
+                        help='replace existing docstrings too, instead of skipping functions that already have one')
+    parser.add_argument('--chat', action='store_true',
+                        help='use the chat completions API with %s, asking for each docstring as structured JSON' % CHAT_MODEL)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='also log each prompt and each documented function to stderr')
+    args = parser.parse_args()
+    # Batch jobs are only for files, since they can take so long
+    if args.batch and not args.filenames:
+        parser.error('--batch needs a filename')
+    # Use as many worker threads as asked for, with a pooled connection for each of them
+    MAX_CONCURRENCY = args.max_concurrency
+    SESSION.mount('https://', make_adapter(MAX_CONCURRENCY))
+    BATCH_SIZE = args.prompts_per_request
+    # Pace the API calls to the account's rate limits
+    LIMITER = RateLimiter(args.max_requests_per_minute, args.max_tokens_per_minute)
+    # Call the API for every function if asked to, instead of reusing cached responses
+    CACHE = LLMCache(CACHE_DIR, enabled=not args.no_cache)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+    # Document stdin if there are no files, otherwise every file, and every Python file in each directory
+    filenames = get_filenames(args.filenames) if args.filenames else [None]
+    # Directories with no Python files in them leave nothing to document, rather than meaning stdin
+    if not filenames:
+        parser.error('no .py files found in %s' % ', '.join(args.filenames))
+    # Split every file up front and document all their functions together, so they share the same worker
+    # threads, rate limits, and deduplication, rather than finishing one file before starting the next
+    files = [get_code_chunks(get_code(filename)) for filename in filenames]
+    # Each function's location is the parts of the file it's in, and its position among them
+    locations = [(parts, i) for parts, positions in files for i in positions]
+    # Leave functions that already have a docstring as they are, without calling the API for them, unless asked not to
+    if not args.force:
+        documented = len(locations)
+        locations = [(parts, i) for parts, i in locations if needs_processing(parts[i])]
+        documented -= len(locations)
+        if documented:
+            logger.info('Skipping %s functions that already have docstrings (use --force to replace them)', documented)
+    # Leave functions too long for the model's context as they are, rather than sending requests the API will reject
+    too_long = [(parts, i) for parts, i in locations if not fits_context(parts[i], args.chat)]
+    if too_long:
+        logger.warning("Skipping %s functions too long for the model's context", len(too_long))
+        locations = [(parts, i) for parts, i in locations if fits_context(parts[i], args.chat)]
+    # Leave one-line functions as they are too, since their docstring would have to go where their body is
+    one_liners = [(parts, i) for parts, i in locations if is_one_liner(parts[i])]
+    if one_liners:
+        logger.info('Skipping %s functions defined on one line', len(one_liners))
+        locations = [(parts, i) for parts, i in locations if not is_one_liner(parts[i])]
+    chunks = [parts[i] for parts, i in locations]
+    # The chat completions API is sent the function itself, and the completions API a prompt to complete
+    prompts = chunks if args.chat else [get_prompt(chunk) for chunk in chunks]
+    logger.debug('Prompts: %s', prompts)
+    # Only send each distinct prompt once, however many copies of the same function there are
+    unique_prompts = list(dict.fromkeys(prompts))
+    # Copies of a function have the same prompt, and the same number of lines to size their responses to
+    max_tokens_by_prompt = {prompt: get_max_tokens(chunk) for prompt, chunk in zip(prompts, chunks)}
+    unique_max_tokens = [max_tokens_by_prompt[prompt] for prompt in unique_prompts]
+    if args.chat and args.batch:
+        unique_responses = get_responses_in_batch_job([get_chat_payload(chunk) for chunk in unique_prompts], CHAT_API_URL)
+    elif args.chat:
+        # The chat completions API takes one function per call, with up to MAX_CONCURRENCY calls in flight at once
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+            unique_responses = list(executor.map(get_chat_response, unique_prompts))
+    elif args.batch:
+        unique_responses = get_responses_in_batch_job([
+            get_payload(prompt, max_tokens) for prompt, max_tokens in zip(unique_prompts, unique_max_tokens)
+        ])
+    else:
+        # Group the prompts into batches of up to BATCH_SIZE prompts, one API call per batch
+        batches = [unique_prompts[i:i + BATCH_SIZE] for i in range(0, len(unique_prompts), BATCH_SIZE)]
+        # Send all the batches up front, with up to MAX_CONCURRENCY API calls in flight at once
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(get_responses, batch, unique_max_tokens[i:i + BATCH_SIZE])
+                for i, batch in zip(range(0, len(unique_prompts), BATCH_SIZE), batches)
+            ]
+        unique_responses = [response for future in futures for response in future.result()]
+    # Give every copy of a function its prompt's response
+    responses_by_prompt = dict(zip(unique_prompts, unique_responses))
+    responses = [responses_by_prompt[prompt] for prompt in prompts]
+    for (parts, i), chunk, response in zip(locations, chunks, responses):
+        # If the API call failed or the response is empty, leave the function as it was and continue to the next chunk
         if not response:
             continue
-        #print("response:",response)
-        function_code = extract_function_code(chunk)
-        #print("function_code:",function_code)
-        new_chunk = '\n'.join([
-            response,
-            function_code
-        ])
-        # Remove any repeated blank lines
-        new_chunk = re.sub(r'\n+\s*\n+\s*\n+', '\n\n', new_chunk)
-
-        #print("new_chunk:",new_chunk)
-        print(new_chunk)
-        #sys.exit()
-        code = code.replace(chunk, new_chunk)
-    output_code(code)
+        # The chat completions API's response is the docstring's contents, to put into the function as it is
+        if args.chat:
+            new_chunk = insert_docstring(chunk, response)
+            if new_chunk is None:
+                logger.warning('Could not use the docstring in the response, leaving this function as it was:\n%s', chunk)
+            else:
+                logger.debug('Documented function:\n%s', new_chunk)
+                parts[i] = new_chunk
+            continue
+        # Only take the docstring from the response, keeping the function's own decorators and signature
+        # rather than whatever Codex wrote back for them
+        header = function_header(chunk)
+        docstring = extract_docstring(response, body_indent(chunk))
+        if header is None or docstring is None:
+            logger.warning('Could not find a docstring for this function in the response, leaving it as it was:\n%s', chunk)
+            continue
+        new_chunk = header + docstring + extract_function_code(chunk)
+        # Never turn a function that parsed into one that doesn't
+        if parses(chunk) and not parses(new_chunk):
+            logger.warning('The documented function would not parse, leaving it as it was:\n%s', chunk)
+            continue
+        # Only log each documented function if asked to, so stdout only ever has the documented code
+        logger.debug('Documented function:\n%s', new_chunk)
+        # Only replace this chunk's own part, rather than searching the whole code for it
+        parts[i] = new_chunk
+    # Write each file's parts out in order, after all the chunks have been replaced
+    for filename, (parts, positions) in zip(filenames, files):
+        output_code(parts, filename)
 
 if __name__ == '__main__':
     main()